@@ -29,7 +29,10 @@
 import math
 import numpy as np
 import os
+import re
 import shutil
+from functools import lru_cache
+from pathlib import Path
 from pyverilator.util.axi_utils import reset_rtlsim, rtlsim_multi_io
 from qonnx.core.datatype import DataType
 from qonnx.util.basic import roundup_to_integer_multiple
@@ -58,6 +61,14 @@ except ModuleNotFoundError:
 class Thresholding_rtl(Thresholding, RTLBackend):
     """Class that corresponds to finn-rtllib 'thresholding' function."""
 
+    # thresholding binary search RTL files in finn-rtllib/thresholding/hdl
+    _rtl_files = (
+        "axilite_if.v",
+        "thresholding.sv",
+        "thresholding_axi.sv",
+        "thresholding_template_wrapper.v",
+    )
+
     def __init__(self, onnx_node, **kwargs):
         super().__init__(onnx_node, **kwargs)
 
@@ -150,8 +161,7 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         dat_files = []
         t_path = self.get_nodeattr("code_gen_dir_ipgen") if abspath else "."
         pe = self.get_nodeattr("PE")
-        output_data_type = self.get_nodeattr("outputDataType")  # output precision
-        o_bitwidth = DataType[output_data_type].bitwidth()
+        o_bitwidth = self.get_output_datatype().bitwidth()  # output precision
         for stage in range(o_bitwidth):
             for pe_value in range(pe):
                 thresh_file = t_path + "/%s_threshs_%s_%s.dat" % (
@@ -169,9 +179,7 @@ class Thresholding_rtl(Thresholding, RTLBackend):
 
         thresholds = model.get_initializer(self.onnx_node.input[1])
         bias = self.get_nodeattr("ActVal")  # activation bias value
-        output_data_type = self.get_nodeattr("outputDataType")  # output precision
-        input_data_type = self.get_nodeattr("inputDataType")  # input/threshold precision
-        o_bitwidth = DataType[output_data_type].bitwidth()
+        o_bitwidth = self.get_output_datatype().bitwidth()  # output precision
 
         t_path = self.get_nodeattr("code_gen_dir_ipgen")
         if self.get_nodeattr("runtime_writeable_weights") == 1:
@@ -238,7 +246,7 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         code_gen_dict["$TOP_MODULE$"] = code_gen_dict["$MODULE_NAME_AXI_WRAPPER$"]
 
         # Identify the module variables
-        i_bitwidth = DataType[input_data_type].bitwidth()
+        i_bitwidth = self.get_input_datatype().bitwidth()  # input/threshold precision
 
         code_gen_dict["$N$"] = [str(o_bitwidth)]  # output precision - convert bitwidth to string
         code_gen_dict["$WT$"] = [
@@ -277,33 +285,44 @@ class Thresholding_rtl(Thresholding, RTLBackend):
 
     def get_rtl_file_list(self):
         """Thresholding binary search RTL file list"""
-        return [
-            "axilite_if.v",
-            "thresholding.sv",
-            "thresholding_axi.sv",
-            "thresholding_template_wrapper.v",
-        ]
+        return self._rtl_files
+
+    @classmethod
+    @lru_cache(maxsize=1)
+    def _get_rtl_file_paths(cls):
+        rtl_root_dir = os.environ["FINN_ROOT"] + "/finn-rtllib/thresholding/hdl/"
+        return tuple(rtl_root_dir + file for file in cls._rtl_files)
 
     def get_rtl_file_paths(self):
         """Get full path of all RTL files"""
-        rtl_root_dir = os.environ["FINN_ROOT"] + "/finn-rtllib/thresholding/hdl/"
-        rtl_file_list = self.get_rtl_file_list()
-        rtl_file_paths = [rtl_root_dir + file for file in rtl_file_list]
-        return rtl_file_paths
+        return self._get_rtl_file_paths()
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _load_template(cls, path):
+        """Read an RTL template file once, its contents are shared by all nodes"""
+        with open(path, "rb") as f:
+            template = f.read().decode("utf-8")
+        return template
 
     def get_rtl_template_data(self, path):
         """Return RTL file contents as a template"""
-        with open(path, "r") as f:
-            template = f.read()
-        return template
+        return self._load_template(path)
+
+    @staticmethod
+    def _make_template_filler(replace_dict):
+        """Return a function that fills in all placeholders of replace_dict
+        in a template with a single pass over the template"""
+        if not replace_dict:
+            return lambda template_data: template_data
+        joined = {key: "\n".join(value) for key, value in replace_dict.items()}
+        # try longer keys first in case one key is a prefix of another
+        pattern = re.compile("|".join(map(re.escape, sorted(joined, key=len, reverse=True))))
+        return lambda template_data: pattern.sub(lambda m: joined[m.group(0)], template_data)
 
     def fill_in_rtl_template_data(self, replace_dict, template_data):
         """Use attribute values to finn in RTL template placeholders"""
-        template_data_cp = template_data
-        for key in replace_dict:
-            replacement_line = "\n".join(replace_dict[key])
-            template_data_cp = template_data_cp.replace(key, replacement_line)
-        return template_data_cp
+        return self._make_template_filler(replace_dict)(template_data)
 
     def dump_rtl_data(self, dest_dir, filename, data):
         """Dump filled-in-template RTL files for future synthesis step"""
@@ -312,8 +331,7 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         # with the node name to distinguish between instances
         if "template" in filename:
             filename = self.get_nodeattr("gen_top_module") + ".v"
-        with open(os.path.join(dest_dir, filename), "w") as f:
-            f.write(data)
+        Path(dest_dir, filename).write_bytes(data.encode("utf-8"))
         return
 
     def generate_hdl(self, model, fpgapart, clk):
@@ -328,14 +346,16 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         # by PyVerilator and IPI generation
         self.set_nodeattr("gen_top_module", code_gen_dict["$TOP_MODULE$"][0])
 
-        for rtl_file_path in self.get_rtl_file_paths():
+        # join the replacement lines once for all templates
+        fill_in_template = self._make_template_filler(code_gen_dict)
+        dest_dir = Path(code_gen_dir)
+        for rtl_file, rtl_file_path in zip(self.get_rtl_file_list(), self.get_rtl_file_paths()):
             # read in original RTL template file
             template_data = self.get_rtl_template_data(rtl_file_path)
             # apply code generation to templates
-            data = self.fill_in_rtl_template_data(code_gen_dict, template_data)
+            data = fill_in_template(template_data)
             # dump filled-in template to destination directory for compilation
-            file_only_path = rtl_file_path.split("/")[-1]
-            self.dump_rtl_data(code_gen_dir, file_only_path, data)
+            self.dump_rtl_data(dest_dir, rtl_file, data)
 
         # set ipgen_path and ip_path so that HLS-Synth transformation
         # and stich_ip transformation do not complain
@@ -475,25 +495,18 @@ class Thresholding_rtl(Thresholding, RTLBackend):
     def code_generation_ipi(self):
         """Constructs and returns the TCL commands for node instantiation as an RTL
         block."""
-        rtl_file_list = [
-            x.replace("thresholding_template_wrapper", self.get_nodeattr("gen_top_module"))
+        gen_top_module = self.get_nodeattr("gen_top_module")
+        code_gen_dir = self.get_nodeattr("code_gen_dir_ipgen")
+        rtl_file_paths = [
+            os.path.join(code_gen_dir, x.replace("thresholding_template_wrapper", gen_top_module))
             for x in self.get_rtl_file_list()
         ]
-        code_gen_dir = self.get_nodeattr("code_gen_dir_ipgen")
-        source_target = "./ip/verilog/rtl_ops/%s" % self.onnx_node.name
-        cmd = ["file mkdir %s" % source_target]
-
-        for rtl_file in rtl_file_list:
-            cmd.append(
-                "add_files -copy_to %s -norecurse %s"
-                % (source_target, os.path.join(code_gen_dir, rtl_file))
-            )
+        source_target = f"./ip/verilog/rtl_ops/{self.onnx_node.name}"
+        cmd = [f"file mkdir {source_target}"]
+        cmd += [f"add_files -copy_to {source_target} -norecurse {path}" for path in rtl_file_paths]
 
         # Create an RTL block, not an IP core (-type ip)
-        cmd.append(
-            "create_bd_cell -type module -reference %s %s"
-            % (self.get_nodeattr("gen_top_module"), self.onnx_node.name)
-        )
+        cmd.append(f"create_bd_cell -type module -reference {gen_top_module} {self.onnx_node.name}")
 
         return cmd
 
@@ -518,8 +531,7 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         thresholds = weights
         pe = self.get_nodeattr("PE")
         ch = self.get_nodeattr("NumChannels")
-        output_data_type = self.get_nodeattr("outputDataType")  # output precision
-        o_bitwidth = DataType[output_data_type].bitwidth()
+        o_bitwidth = self.get_output_datatype().bitwidth()  # output precision
         # The RTL expects 2^N-1 thresholds, but narrow range quantization will result in
         # one less threshold, prepending a dummy threshold (minimal possible value determined by
         # input data type) and decrease the bias by 1.
@@ -540,28 +552,18 @@ class Thresholding_rtl(Thresholding, RTLBackend):
         width_padded = roundup_to_integer_multiple(thresholds.shape[1], 2**o_bitwidth)
         thresh_padded = np.zeros((thresholds.shape[0], width_padded))
         thresh_padded[: thresholds.shape[0], :n_thres_steps] = thresholds
-        thresh_stream = []
         wdt = self.get_weight_datatype()
         bw_hexdigit = roundup_to_integer_multiple(wdt.bitwidth(), 32)
-        padding = np.zeros(width_padded, dtype=np.int32)
 
-        chan_ind = 0
+        # lay out the channels of each fold PE by PE, padding the PE dimension
+        # with zero thresholds up to the next power of two (AXI-lite address map)
         cf = ch // pe
-        for fold in range(cf):
-            for c in range(2 ** (pe - 1).bit_length()):
-                if (c == 0 or c % pe != 0) and c < pe:
-                    for t in thresh_padded[chan_ind]:
-                        t_packed = pack_innermost_dim_as_hex_string(
-                            [t], wdt, bw_hexdigit, prefix=""
-                        ).item()
-                        thresh_stream.append(t_packed)
-                    chan_ind += 1
-                else:
-                    for z in padding:
-                        t_packed = pack_innermost_dim_as_hex_string(
-                            [z], wdt, bw_hexdigit, prefix=""
-                        ).item()
-                        thresh_stream.append(t_packed)
+        pe_padded = 2 ** (pe - 1).bit_length()
+        thresh_stream = np.zeros((cf, pe_padded, width_padded))
+        thresh_stream[:, :pe] = thresh_padded.reshape(cf, pe, width_padded)
+        # pack all thresholds in one call, one value per line
+        t_packed = pack_innermost_dim_as_hex_string(
+            np.expand_dims(thresh_stream, axis=-1), wdt, bw_hexdigit, prefix=""
+        )
         with open(weight_file_name, "w") as f:
-            for val in thresh_stream:
-                f.write(val + "\n")
+            f.write("\n".join(t_packed.flatten()) + "\n")
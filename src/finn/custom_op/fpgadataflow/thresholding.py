@@ -28,16 +28,59 @@
 
 import numpy as np
 import warnings
+from functools import cached_property, lru_cache
 from qonnx.core.datatype import DataType
-from qonnx.custom_op.general.multithreshold import multithreshold
 from qonnx.util.basic import interleave_matrix_outer_dim_from_partitions
 
 from finn.custom_op.fpgadataflow.hwcustomop import HWCustomOp
 
+# FINN DataTypes by name, shared by all Thresholding nodes
+_DT = {}
+
+
+def _dt(name):
+    """Return the FINN DataType with the given name."""
+    if name not in _DT:
+        _DT[name] = DataType[name]
+    return _DT[name]
+
+
+# minimum number of input values times thresholds for which execute_node
+# uses the parallel numba kernel instead of the numpy reference
+_NUMBA_MIN_WORK = 2**20
+# input and threshold dtypes the numba kernel can be compiled for
+_NUMBA_DTYPES = (np.float32, np.float64)
+
+
+@lru_cache(maxsize=1)
+def _get_threshold_search_kernel():
+    """Return the parallel numba threshold search kernel, or None if numba
+    is not installed or cannot be imported. numba is only imported on first
+    use, so importing FINN does not pay for it."""
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, cache=True)
+    def threshold_search(x, th_sorted, out):
+        for n in prange(x.shape[0]):
+            for c in range(x.shape[1]):
+                out[n, c] = np.searchsorted(th_sorted[c], x[n, c], side="right")
+
+    return threshold_search
+
 
 class Thresholding(HWCustomOp):
     """Abstraction layer for HW implementation of Thresholding."""
 
+    # memoized node attribute values, dropped whenever an attribute is set
+    # through this instance. Changes made through another instance wrapping
+    # the same node (e.g. from a second getCustomOp call) are not seen, so
+    # don't hold on to an instance across attribute edits made elsewhere.
+    # Every cached_property below must be listed here.
+    _cached_nodeattrs = ("_pe", "_num_channels", "_num_steps", "_vecs", "_idt", "_odt", "_wdt")
+
     def __init__(self, onnx_node, **kwargs):
         super().__init__(onnx_node, **kwargs)
 
@@ -68,6 +111,39 @@ class Thresholding(HWCustomOp):
         my_attrs.update(super().get_nodeattr_types())
         return my_attrs
 
+    def set_nodeattr(self, name, value):
+        super().set_nodeattr(name, value)
+        for cached in self._cached_nodeattrs:
+            self.__dict__.pop(cached, None)
+
+    @cached_property
+    def _pe(self):
+        return self.get_nodeattr("PE")
+
+    @cached_property
+    def _num_channels(self):
+        return self.get_nodeattr("NumChannels")
+
+    @cached_property
+    def _num_steps(self):
+        return self.get_nodeattr("numSteps")
+
+    @cached_property
+    def _vecs(self):
+        return tuple(self.get_nodeattr("numInputVectors"))
+
+    @cached_property
+    def _idt(self):
+        return _dt(self.get_nodeattr("inputDataType"))
+
+    @cached_property
+    def _odt(self):
+        return _dt(self.get_nodeattr("outputDataType"))
+
+    @cached_property
+    def _wdt(self):
+        return _dt(self.get_nodeattr("weightDataType"))
+
     def make_shape_compatible_op(self, model):
         oshape = self.get_normal_output_shape()
         return super().make_const_shape_op(oshape)
@@ -113,22 +189,20 @@ class Thresholding(HWCustomOp):
 
     def get_input_datatype(self, ind=0):
         """Returns FINN DataType of input."""
-        return DataType[self.get_nodeattr("inputDataType")]
+        return self._idt
 
     def get_output_datatype(self, ind=0):
         """Returns FINN DataType of output."""
-        return DataType[self.get_nodeattr("outputDataType")]
+        return self._odt
 
     def get_weight_datatype(self):
         """Returns FINN DataType of thresholds, here called weights."""
-        return DataType[self.get_nodeattr("weightDataType")]
+        return self._wdt
 
     def get_weightstream_width(self):
         """Returns weight stream width"""
-        pe = self.get_nodeattr("PE")
         wp = self.get_weight_datatype().bitwidth()
-        n_thres_steps = self.get_nodeattr("numSteps")
-        w_width = pe * wp * n_thres_steps
+        w_width = self._pe * wp * self._num_steps
         return w_width
 
     def minimize_accumulator_width(self, model):
@@ -155,32 +229,26 @@ class Thresholding(HWCustomOp):
         self.set_nodeattr("weightDataType", tdt.name)
         # Update QONNX DataType of tensor for consistency
         model.set_tensor_datatype(self.onnx_node.input[1], tdt)
-        return DataType[self.get_nodeattr("weightDataType")]
+        return self.get_weight_datatype()
 
     def get_instream_width(self, ind=0):
         i_bits = self.get_input_datatype().bitwidth()
-        return i_bits * self.get_nodeattr("PE")
+        return i_bits * self._pe
 
     def get_outstream_width(self, ind=0):
         o_bits = self.get_output_datatype().bitwidth()
-        return o_bits * self.get_nodeattr("PE")
+        return o_bits * self._pe
 
     def get_folded_input_shape(self, ind=0):
-        pe = self.get_nodeattr("PE")
         fold = self.calc_tmem()
-        vecs = list(self.get_nodeattr("numInputVectors"))
-        folded_input_shape = tuple(vecs + [fold, pe])
-        return folded_input_shape
+        return self._vecs + (fold, self._pe)
 
     def get_folded_output_shape(self, ind=0):
         # same shape as input
         return self.get_folded_input_shape()
 
     def get_normal_input_shape(self, ind=0):
-        ich = self.get_nodeattr("NumChannels")
-        vecs = list(self.get_nodeattr("numInputVectors"))
-        normal_input_shape = tuple(vecs + [ich])
-        return normal_input_shape
+        return self._vecs + (self._num_channels,)
 
     def get_normal_output_shape(self, ind=0):
         # same shape as input
@@ -243,17 +311,31 @@ class Thresholding(HWCustomOp):
         inp_values = context[node.input[0]]
         th_val = context[node.input[1]]
         out_bias = self.get_nodeattr("ActVal")
-        # MT expects inputs to be in the shape (N,C,H,W) or (N, C)
-        # if 4D then input values in context are (N,H,W,C) and need to
-        # be transposed.
-        # if 2D then inputs can be passed directly to MT function
-        is_4d = len(inp_values.shape) == 4
-        if is_4d:
-            inp_values = np.transpose(inp_values, (0, 3, 1, 2))
-        y = multithreshold(inp_values, th_val, out_bias=out_bias)
-        if is_4d:
-            y = y.transpose(0, 2, 3, 1)
-        act = DataType[self.get_nodeattr("outputDataType")]
+        # input values in context are channels-last (..., C) and thresholds
+        # are (C, n_thres), or (1, n_thres) if shared by all channels.
+        # The number of thresholds reached does not depend on their order,
+        # so sort each channel's thresholds and binary search for it.
+        # The output keeps the dtype of the input values.
+        num_channels = inp_values.shape[-1]
+        th_sorted = np.sort(np.broadcast_to(th_val, (num_channels, th_val.shape[-1])), axis=1)
+        x = inp_values.reshape(-1, num_channels)
+        y = np.empty(x.shape, dtype=inp_values.dtype)
+        kernel = None
+        if (
+            x.size * th_sorted.shape[1] >= _NUMBA_MIN_WORK
+            and x.dtype in _NUMBA_DTYPES
+            and th_sorted.dtype in _NUMBA_DTYPES
+        ):
+            kernel = _get_threshold_search_kernel()
+        if kernel is not None:
+            kernel(np.ascontiguousarray(x), th_sorted, y)
+        else:
+            for ch in range(num_channels):
+                y[:, ch] = np.searchsorted(th_sorted[ch], x[:, ch], side="right")
+        # NaN compares false against every threshold, but sorts after all of them
+        y[np.isnan(x)] = 0
+        y = (y + out_bias).reshape(inp_values.shape)
+        act = self.get_output_datatype()
         if act == DataType["BIPOLAR"]:
             # binary to bipolar
             y = 2 * y - 1
@@ -261,6 +343,4 @@ class Thresholding(HWCustomOp):
 
     def calc_tmem(self):
         """Calculates and returns TMEM."""
-        num_channels = self.get_nodeattr("NumChannels")
-        pe = self.get_nodeattr("PE")
-        return num_channels // pe
+        return self._num_channels // self._pe
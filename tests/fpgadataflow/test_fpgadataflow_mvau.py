@@ -677,9 +677,8 @@ def test_fpgadataflow_rtl_mvau(mh, mw, pe, simd, idt, wdt, part, clk_ns):
 
     # Create MVAU (HLS)
     model = model.transform(to_hw.InferQuantizedMatrixVectorActivation())
-    model = model.transform(GiveUniqueNodeNames())
 
-    # Apply convert-to-rtl step
+    # Apply convert-to-rtl step, the specialized node is named afterwards
     model = model.transform(SpecializeLayers(part))
     model = model.transform(GiveUniqueNodeNames())
 
@@ -29,9 +29,11 @@
 import pytest
 
 import numpy as np
+from functools import cached_property
 from onnx import TensorProto, helper
 from qonnx.core.datatype import DataType
 from qonnx.core.modelwrapper import ModelWrapper
+from qonnx.custom_op.general.multithreshold import multithreshold
 from qonnx.custom_op.registry import getCustomOp
 from qonnx.transformation.general import GiveUniqueNodeNames
 from qonnx.transformation.infer_datatypes import InferDataTypes
@@ -41,6 +43,10 @@ from qonnx.util.basic import gen_finn_dt_tensor
 import finn.core.onnx_exec as oxe
 from finn.analysis.fpgadataflow.exp_cycles_per_layer import exp_cycles_per_layer
 from finn.analysis.fpgadataflow.hls_synth_res_estimation import hls_synth_res_estimation
+from finn.custom_op.fpgadataflow.thresholding import (
+    Thresholding,
+    _get_threshold_search_kernel,
+)
 from finn.transformation.fpgadataflow.compile_cppsim import CompileCppSim
 from finn.transformation.fpgadataflow.convert_to_hw_layers import InferThresholdingLayer
 from finn.transformation.fpgadataflow.hlssynth_ip import HLSSynthIP
@@ -129,7 +135,15 @@ def make_single_multithresholding_modelwrapper(
         [1, 2, 2],
     ],
 )
-@pytest.mark.parametrize("activation", [DataType["INT4"], DataType["BIPOLAR"]])
+# narrow range is not supported with bipolar activation
+@pytest.mark.parametrize(
+    "activation,narrow",
+    [
+        (DataType["INT4"], True),
+        (DataType["INT4"], False),
+        (DataType["BIPOLAR"], False),
+    ],
+)
 @pytest.mark.parametrize(
     "idt_tdt_cfg",
     [
@@ -140,11 +154,18 @@ def make_single_multithresholding_modelwrapper(
     ],
 )
 @pytest.mark.parametrize("fold", [-1, 1, 2])
-@pytest.mark.parametrize("narrow", [True, False])
 @pytest.mark.parametrize("per_tensor", [True, False])
-@pytest.mark.parametrize("impl_style", ["hls", "rtl"])
+# the mem_mode parameter can only be used for the hls thresholding,
+# so the rtl variant is only collected once and not once per mem_mode
+@pytest.mark.parametrize(
+    "impl_style,mem_mode",
+    [
+        ("hls", "internal_embedded"),
+        ("hls", "internal_decoupled"),
+        ("rtl", "internal_embedded"),
+    ],
+)
 @pytest.mark.parametrize("exec_mode", ["cppsim", "rtlsim"])
-@pytest.mark.parametrize("mem_mode", ["internal_embedded", "internal_decoupled"])
 @pytest.mark.fpgadataflow
 @pytest.mark.vivado
 @pytest.mark.slow
@@ -152,24 +173,14 @@ def test_fpgadataflow_thresholding(
     num_input_channels,
     num_input_vecs,
     activation,
+    narrow,
     idt_tdt_cfg,
     fold,
-    narrow,
     per_tensor,
     impl_style,
-    exec_mode,
     mem_mode,
+    exec_mode,
 ):
-    # the mem_mode parameter can only be used for the hls thresholding
-    # so the test will only be executed once for impl_style=rtl and once skipped
-    # when the mem_mode is varied. Otherwise, the same test configuration would always
-    # run twice.
-    if impl_style == "rtl" and mem_mode == "internal_decoupled":
-        pytest.skip(
-            "Skip, because test is identical to impl_style=rtl and mem_mode=internal_embedded"
-        )
-    if narrow and activation == DataType["BIPOLAR"]:
-        pytest.skip("Narrow needs to be false with biploar activation.")
     input_data_type, threshold_data_type = idt_tdt_cfg
     num_steps = activation.get_num_possible_values() - 1
 
@@ -263,3 +274,106 @@ def test_fpgadataflow_thresholding(
         exp_cycles = exp_cycles_dict[node.name]
         assert np.isclose(exp_cycles, cycles_rtlsim, atol=15)
         assert exp_cycles != 0
+
+
+def make_thresholding_op(num_input_vecs, num_channels, num_steps, output_data_type, act_val):
+    node = helper.make_node(
+        "Thresholding",
+        ["inp", "thresh"],
+        ["outp"],
+        domain="finn.custom_op.fpgadataflow",
+        backend="fpgadataflow",
+        PE=1,
+        NumChannels=num_channels,
+        numSteps=num_steps,
+        inputDataType="INT8",
+        weightDataType="INT8",
+        outputDataType=output_data_type.name,
+        numInputVectors=num_input_vecs,
+        ActVal=act_val,
+    )
+    return getCustomOp(node)
+
+
+@pytest.mark.parametrize("num_input_vecs", [[2], [1, 2, 2]])
+@pytest.mark.parametrize("activation", [DataType["INT4"], DataType["BIPOLAR"]])
+@pytest.mark.parametrize("per_tensor", [True, False])
+# float16 is not supported by the numba kernel and must fall back to numpy
+@pytest.mark.parametrize("inp_dtype", [np.float16, np.float32, np.float64])
+# 0 executes with the numba kernel (if installed), inf with numpy searchsorted
+@pytest.mark.parametrize("numba_min_work", [0, np.inf])
+@pytest.mark.fpgadataflow
+def test_fpgadataflow_thresholding_execute_node(
+    num_input_vecs, activation, per_tensor, inp_dtype, numba_min_work, monkeypatch
+):
+    if numba_min_work == 0:
+        pytest.importorskip("numba")
+        assert _get_threshold_search_kernel() is not None
+    monkeypatch.setattr(
+        "finn.custom_op.fpgadataflow.thresholding._NUMBA_MIN_WORK", numba_min_work
+    )
+    num_channels = 6
+    num_steps = activation.get_num_possible_values() - 1
+    act_val = 0 if activation == DataType["BIPOLAR"] else activation.min()
+    # thresholds are left unsorted, execution must not depend on their order
+    thresholds = generate_random_threshold_values(
+        DataType["INT8"], num_channels, num_steps, per_tensor=per_tensor
+    )
+    op = make_thresholding_op(num_input_vecs, num_channels, num_steps, activation, act_val)
+    x = gen_finn_dt_tensor(DataType["INT8"], tuple(num_input_vecs + [num_channels]))
+    x = x.astype(inp_dtype)
+    # NaN inputs reach no threshold
+    x.flat[0] = np.nan
+    context = {"inp": x, "thresh": thresholds}
+    op.execute_node(context, None)
+    y_produced = context["outp"]
+
+    # multithreshold expects channels in the second dimension
+    x_mt = np.transpose(x, (0, 3, 1, 2)) if x.ndim == 4 else x
+    y_expected = multithreshold(x_mt, thresholds, out_bias=act_val)
+    if x.ndim == 4:
+        y_expected = y_expected.transpose(0, 2, 3, 1)
+    if activation == DataType["BIPOLAR"]:
+        # binary to bipolar
+        y_expected = 2 * y_expected - 1
+
+    assert y_produced.dtype == inp_dtype
+    assert (y_produced == y_expected).all()
+
+
+@pytest.mark.fpgadataflow
+def test_fpgadataflow_thresholding_nodeattr_cache():
+    # every memoized attribute must be dropped by set_nodeattr
+    cached = {name for name, val in vars(Thresholding).items() if isinstance(val, cached_property)}
+    assert cached == set(Thresholding._cached_nodeattrs)
+
+    op = make_thresholding_op([1, 4, 4], 16, 15, DataType["INT4"], -8)
+    assert op.get_instream_width() == 8
+    assert op.get_outstream_width() == 4
+    assert op.get_weightstream_width() == 8 * 15
+    assert op.get_normal_input_shape() == (1, 4, 4, 16)
+    assert op.get_folded_input_shape() == (1, 4, 4, 16, 1)
+    assert op.get_input_datatype() == DataType["INT8"]
+    assert op.get_output_datatype() == DataType["INT4"]
+    assert op.get_weight_datatype() == DataType["INT8"]
+    assert all(name in op.__dict__ for name in Thresholding._cached_nodeattrs)
+
+    op.set_nodeattr("ActVal", 0)
+    assert not any(name in op.__dict__ for name in Thresholding._cached_nodeattrs)
+
+    op.set_nodeattr("PE", 4)
+    op.set_nodeattr("NumChannels", 8)
+    op.set_nodeattr("numSteps", 3)
+    op.set_nodeattr("numInputVectors", [2])
+    op.set_nodeattr("inputDataType", "UINT4")
+    op.set_nodeattr("outputDataType", "UINT2")
+    op.set_nodeattr("weightDataType", "INT9")
+    assert op.get_instream_width() == 16
+    assert op.get_outstream_width() == 8
+    assert op.get_weightstream_width() == 4 * 9 * 3
+    assert op.get_normal_input_shape() == (2, 8)
+    assert op.get_folded_input_shape() == (2, 2, 4)
+    assert op.calc_tmem() == 2
+    assert op.get_input_datatype() == DataType["UINT4"]
+    assert op.get_output_datatype() == DataType["UINT2"]
+    assert op.get_weight_datatype() == DataType["INT9"]